@@ -9,11 +9,11 @@ setup(
     url="https://github.com/molobrakos/tellduslive",
     author="Erik",
     author_email="error.errorsson@gmail.com",
-    install_requires=["requests", "requests_oauthlib"],
+    install_requires=["requests", "requests_oauthlib", "urllib3"],
     py_modules=["tellduslive"],
     provides=["tellduslive"],
     scripts=["tellduslive"],
-    extras_require={"console": ["docopt"]},
+    extras_require={"console": ["docopt"], "speedups": ["orjson"]},
     classifiers=[
         "License :: OSI Approved :: The Unlicense (Unlicense)"
     ],
@@ -2,11 +2,33 @@
 # -*- mode: python; coding: utf-8 -*-
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
+from os.path import join, dirname, expanduser
+import re
+import socket
 import sys
+from time import monotonic, time
 import requests
-from requests.compat import urljoin
+from requests.adapters import HTTPAdapter
+from requests.compat import urlencode, urljoin
 from requests_oauthlib import OAuth1Session
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import loads as _json_loads
+
+    def _decode_json(response):
+        """Decode the raw body of response."""
+        return _json_loads(response.content)
+
+except ImportError:
+    from json import loads as _json_loads
+
+    def _decode_json(response):
+        """Decode the body of response (json.loads takes str only on 3.5)."""
+        return _json_loads(response.text)
 
 sys.version_info >= (3, 0) or exit("Python 3 required")
 
@@ -26,6 +48,28 @@ TELLDUS_LOCAL_REQUEST_TOKEN_URL = "http://{host}/api/token"
 TELLDUS_LOCAL_REFRESH_TOKEN_URL = "http://{host}/api/refreshToken"
 
 TIMEOUT = timedelta(seconds=10)
+_TIMEOUT_SECONDS = TIMEOUT.total_seconds()
+
+TOKEN_REFRESH_INTERVAL = timedelta(hours=12)
+TOKEN_EXPIRY_MARGIN = timedelta(minutes=1)
+
+# HTTP connection pool sizing per session
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 10
+
+# Retry connection errors and gateway errors with exponential backoff,
+# then hand the last response back for raise_for_status to report.
+# Read errors are not retried: device commands are GETs, and a command
+# that timed out may already have been carried out. Retry-After is ignored
+# so that a 503 asking for a long pause cannot stall the caller for minutes.
+_RETRY = Retry(
+    total=3,
+    read=0,
+    backoff_factor=0.3,
+    status_forcelist=(502, 503, 504),
+    raise_on_status=False,
+    respect_retry_after_header=False,
+)
 
 UNNAMED_DEVICE = "NO NAME"
 
@@ -45,6 +89,17 @@ THERMOSTAT = 2048
 
 SUPPORTED_METHODS = TURNON | TURNOFF | DIM | UP | DOWN | STOP
 
+# States in which a device is considered on
+_ON_STATES = frozenset([TURNON, DIM])
+
+# API paths of the list requests, with their fixed query strings
+_DEVICES_LIST_PATH = "devices/list?" + urlencode(
+    dict(supportedMethods=SUPPORTED_METHODS, includeIgnored=0)
+)
+_SENSORS_LIST_PATH = "sensors/list?" + urlencode(
+    dict(includeValues=1, includeScale=1, includeIgnored=0)
+)
+
 METHODS = {
     TURNON: "turnOn",
     TURNOFF: "turnOff",
@@ -59,6 +114,14 @@ METHODS = {
     THERMOSTAT: "thermostat",
 }
 
+# API paths of device commands
+_COMMAND_PATHS = {method: "device/" + name for method, name in METHODS.items()}
+
+# (method, display name) pairs, in METHODS order
+_METHOD_NAMES = tuple(
+    (method, name.upper()) for method, name in METHODS.items()
+)
+
 # Sensor types
 TEMPERATURE = "temperature"
 HUMIDITY = "humidity"
@@ -78,13 +141,33 @@ BATTERY_UNKNOWN = 254
 BATTERY_OK = 253
 
 SUPPORTS_LOCAL_API = ["TellstickZnet", "TellstickNetV2"]
+_SUPPORTS_LOCAL_API_RE = re.compile(
+    "|".join(re.escape(dev) for dev in SUPPORTS_LOCAL_API)
+)
 
 DEFAULT_APPLICATION_NAME = "tellduslive"
 
 
 def supports_local_api(device):
     """Return true if the device supports local access."""
-    return any(dev in device for dev in SUPPORTS_LOCAL_API)
+    return _SUPPORTS_LOCAL_API_RE.search(device) is not None
+
+
+@lru_cache(maxsize=128)
+def _str_methods(val):
+    """String representation of methods or state."""
+    return "|".join(name for method, name in _METHOD_NAMES if val & method)
+
+
+def _mount_adapter(session):
+    """Mount a pooling, retrying HTTP adapter on the session."""
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        max_retries=_RETRY,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
 
 
 class LocalAPISession(requests.Session):
@@ -92,12 +175,15 @@ class LocalAPISession(requests.Session):
 
     def __init__(self, host, application, access_token=None):
         super().__init__()
+        _mount_adapter(self)
         self.url = TELLDUS_LOCAL_API_URL.format(host=host)
         self._host = host
         self._hub_id = None
         self._application = application or DEFAULT_APPLICATION_NAME
         self.request_token = None
         self.token_timestamp = None
+        self._refresh_due = None
+        self._discovery_socket = None
         self.access_token = access_token
         if access_token:
             self.headers.update(
@@ -107,10 +193,12 @@ class LocalAPISession(requests.Session):
 
     def discovery_info(self):
         """Retrive information from discovery socket."""
-        import socket
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(1)
+        if self._discovery_socket is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.settimeout(1)
+            self._discovery_socket = sock
+        sock = self._discovery_socket
         try:
             sock.sendto(b"D", (self._host, 30303))
             data, (address, _) = sock.recvfrom(1024)
@@ -135,6 +223,13 @@ class LocalAPISession(requests.Session):
         self._hub_id = entry[1]
         return ret
 
+    def close(self):
+        """Close the discovery socket and all pooled connections."""
+        if self._discovery_socket is not None:
+            self._discovery_socket.close()
+            self._discovery_socket = None
+        super().close()
+
     @property
     def hub_id(self):
         return self._hub_id
@@ -146,7 +241,7 @@ class LocalAPISession(requests.Session):
             response = self.put(
                 TELLDUS_LOCAL_REQUEST_TOKEN_URL.format(host=self._host),
                 data={"app": self._application},
-                timeout=TIMEOUT.seconds,
+                timeout=_TIMEOUT_SECONDS,
             )
             response.raise_for_status()
             result = response.json()
@@ -161,7 +256,7 @@ class LocalAPISession(requests.Session):
             response = self.get(
                 TELLDUS_LOCAL_REQUEST_TOKEN_URL.format(host=self._host),
                 params=dict(token=self.request_token),
-                timeout=TIMEOUT.seconds,
+                timeout=_TIMEOUT_SECONDS,
             )
             response.raise_for_status()
             result = response.json()
@@ -171,8 +266,12 @@ class LocalAPISession(requests.Session):
                     {"Authorization": "Bearer {}".format(self.access_token)}
                 )
                 self.token_timestamp = datetime.now()
-                token_expiry = datetime.fromtimestamp(result.get("expires"))
-                _LOGGER.debug("Token expires %s", token_expiry)
+                self._schedule_refresh(result.get("expires"))
+                if _LOGGER.isEnabledFor(logging.DEBUG):
+                    _LOGGER.debug(
+                        "Token expires %s",
+                        datetime.fromtimestamp(result.get("expires")),
+                    )
                 return True
         except OSError as e:
             _LOGGER.error("Failed to authorize: %s", e)
@@ -186,9 +285,17 @@ class LocalAPISession(requests.Session):
             response.raise_for_status()
             result = response.json()
             self.access_token = result.get("token")
+            if self.access_token:
+                self.headers.update(
+                    {"Authorization": "Bearer {}".format(self.access_token)}
+                )
             self.token_timestamp = datetime.now()
-            token_expiry = datetime.fromtimestamp(result.get("expires"))
-            _LOGGER.debug("Token expires %s", token_expiry)
+            self._schedule_refresh(result.get("expires"))
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug(
+                    "Token expires %s",
+                    datetime.fromtimestamp(result.get("expires")),
+                )
             return True
         except OSError as e:
             _LOGGER.error("Failed to refresh access token: %s", e)
@@ -198,12 +305,24 @@ class LocalAPISession(requests.Session):
         """Return true if successfully authorized."""
         return self.access_token
 
+    def _schedule_refresh(self, expires=None):
+        """Remember when the current access token should be refreshed.
+
+        Refresh just before the expiry reported by the server, on the next
+        request if that is already less than TOKEN_EXPIRY_MARGIN away, or
+        after TOKEN_REFRESH_INTERVAL if the server did not report one."""
+        if expires:
+            lifetime = max(
+                expires - time() - TOKEN_EXPIRY_MARGIN.total_seconds(), 0
+            )
+        else:
+            lifetime = TOKEN_REFRESH_INTERVAL.total_seconds()
+        self._refresh_due = monotonic() + lifetime
+
     def maybe_refresh_token(self):
         """Refresh access_token if expired."""
-        if self.token_timestamp:
-            age = datetime.now() - self.token_timestamp
-            if age > timedelta(seconds=(12 * 60 * 60)):  # 12 hours
-                self.refresh_access_token()
+        if self._refresh_due and monotonic() >= self._refresh_due:
+            self.refresh_access_token()
 
 
 class LiveAPISession(OAuth1Session):
@@ -219,6 +338,7 @@ class LiveAPISession(OAuth1Session):
         application=None,
     ):
         super().__init__(public_key, private_key, token, token_secret)
+        _mount_adapter(self)
         self.url = TELLDUS_LIVE_API_URL
         self.access_token = None
         self.access_token_secret = None
@@ -235,7 +355,7 @@ class LiveAPISession(OAuth1Session):
         _LOGGER.debug("Fetching request token")
         try:
             self.fetch_request_token(
-                TELLDUS_LIVE_REQUEST_TOKEN_URL, timeout=TIMEOUT.seconds
+                TELLDUS_LIVE_REQUEST_TOKEN_URL, timeout=_TIMEOUT_SECONDS
             )
             _LOGGER.debug("Got request token")
             return self.authorization_url(TELLDUS_LIVE_AUTHORIZE_URL)
@@ -247,7 +367,7 @@ class LiveAPISession(OAuth1Session):
         try:
             _LOGGER.debug("Fetching access token")
             token = self._fetch_token(
-                TELLDUS_LIVE_ACCESS_TOKEN_URL, timeout=TIMEOUT.seconds
+                TELLDUS_LIVE_ACCESS_TOKEN_URL, timeout=_TIMEOUT_SECONDS
             )
             _LOGGER.debug("Got access token")
             self.access_token = token["oauth_token"]
@@ -278,6 +398,7 @@ class Session:
         token_secret=None,
         host=None,
         application=None,
+        cache_ttl=None,
     ):
 
         _LOGGER.info("%s version %s", __name__, __version__)
@@ -291,6 +412,11 @@ class Session:
             raise ValueError("Missing configuration")
 
         self._state = {}
+        self._urls = {}
+        self._devices = {}
+        # update() reuses device and sensor lists younger than cache_ttl
+        self._cache_ttl = cache_ttl.total_seconds() if cache_ttl else 0
+        self._cache = {}
         self._session = (
             LocalAPISession(host, application, token)
             if host
@@ -331,66 +457,96 @@ class Session:
         """Send a request to the Tellstick Live API."""
         try:
             self._session.maybe_refresh_token()
-            url = urljoin(self._session.url, path)
+            url = self._urls.get(path)
+            if url is None:
+                url = self._urls[path] = urljoin(self._session.url, path)
             _LOGGER.debug("Request %s %s", url, params)
             response = self._session.get(
-                url, params=params, timeout=TIMEOUT.seconds
+                url, params=params, timeout=_TIMEOUT_SECONDS
             )
             response.raise_for_status()
-            _LOGGER.debug(
-                "Response %s %s %s",
-                response.status_code,
-                response.headers["content-type"],
-                response.json(),
-            )
-            response = response.json()
-            if "error" in response:
-                raise OSError(response["error"])
-            return response
-        except OSError as error:
+            result = _decode_json(response)
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug(
+                    "Response %s %s %s",
+                    response.status_code,
+                    response.headers["content-type"],
+                    result,
+                )
+            if "error" in result:
+                raise OSError(result["error"])
+            return result
+        except (OSError, ValueError) as error:
             _LOGGER.warning("Failed request: %s", error)
 
     def execute(self, method, **params):
         """Make request, check result if successful."""
         response = self._request(method, **params)
-        return response and response.get("status") == "success"
+        if response and response.get("status") == "success":
+            # the cached lists no longer reflect the device states
+            self._cache.clear()
+            return True
+        return False
+
+    def fan_out(self, devices, action):
+        """Call action(device) for each device concurrently.
+
+        action is a callable taking a device, e.g. Device.turn_on or
+        lambda device: device.dim(128). Return the results in the order
+        of devices.
+        """
+        # refresh once up front so the concurrent requests share the token
+        self._session.maybe_refresh_token()
+        with ThreadPoolExecutor(max_workers=POOL_MAXSIZE) as executor:
+            return list(executor.map(action, devices))
+
+    def _cached_request(self, path):
+        """Send a request, reusing a response younger than cache_ttl."""
+        if self._cache_ttl:
+            cached = self._cache.get(path)
+            if cached and monotonic() - cached[0] < self._cache_ttl:
+                return cached[1]
+        res = self._request(path)
+        if self._cache_ttl and res:
+            self._cache[path] = (monotonic(), res)
+        return res
 
     def _request_devices(self):
         """Request list of devices from server."""
-        res = self._request(
-            "devices/list",
-            supportedMethods=SUPPORTED_METHODS,
-            includeIgnored=0,
-        )
+        res = self._cached_request(_DEVICES_LIST_PATH)
         return res.get("device") if res else None
 
     def _request_sensors(self):
         """Request list of sensors from server."""
-        res = self._request(
-            "sensors/list", includeValues=1, includeScale=1, includeIgnored=0
-        )
+        res = self._cached_request(_SENSORS_LIST_PATH)
         return res.get("sensor") if res else None
 
     def update(self):
         """Updates all devices and sensors from server."""
 
-        def collect(devices, is_sensor=False):
-            """Update local state.
-            N.B. We prefix sensors with '_', since apparently sensors
-            and devices do not share name space and there can be
-            collissions.
-            FIXME: Remove this hack."""
-            return {
-                "_" * is_sensor + str(device["id"]): device
-                for device in devices or {}
-                if device["name"] and not (is_sensor and "data" not in device)
-            }
-
-        devices = self._request_devices()
-        sensors = self._request_sensors()
-        new_state = collect(devices)
-        new_state.update(collect(sensors, True))
+        # refresh once up front so the concurrent requests share the token
+        self._session.maybe_refresh_token()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            devices = executor.submit(self._request_devices)
+            sensors = executor.submit(self._request_sensors)
+            devices, sensors = devices.result(), sensors.result()
+        new_state = {}
+        for device in devices or ():
+            if device["name"]:
+                new_state[str(device["id"])] = device
+        # N.B. We prefix sensors with '_', since apparently sensors
+        # and devices do not share name space and there can be
+        # collissions.
+        # FIXME: Remove this hack.
+        for sensor in sensors or ():
+            if sensor["name"] and "data" in sensor:
+                new_state["_" + str(sensor["id"])] = sensor
         self._state = new_state
+        # keep the Device objects of known ids so their caches survive
+        self._devices = {
+            device_id: self._devices.get(device_id) or Device(self, device_id)
+            for device_id in new_state
+        }
 
         return devices is not None and sensors is not None
 
@@ -413,7 +569,8 @@ class Session:
 
     def device(self, device_id):
         """Return a device object."""
-        return Device(self, device_id)
+        device = self._devices.get(device_id)
+        return device if device is not None else Device(self, device_id)
 
     @property
     def sensors(self):
@@ -424,7 +581,7 @@ class Session:
     @property
     def devices(self):
         """Request representations of all devices."""
-        return (self.device(device_id) for device_id in self.device_ids)
+        return iter(self._devices.values())
 
     @property
     def device_ids(self):
@@ -435,42 +592,86 @@ class Session:
 class Device:
     """Tellduslive device."""
 
+    __slots__ = (
+        "_session",
+        "_device_id",
+        "_cached",
+        "_items_data",
+        "_items",
+        "_items_index",
+    )
+
     def __init__(self, session, device_id):
         self._session = session
         self._device_id = device_id
+        self._cached = (None, None)
+        self._items_data = None
+        self._items = None
+        self._items_index = None
 
     def __str__(self):
-        if self.is_sensor:
-            items = ", ".join(str(item) for item in self.items)
+        device = self.device
+        name = device.get("name") or UNNAMED_DEVICE
+        if "data" in device:
             return "Sensor #{id:>9} {name:<20} ({items})".format(
-                id=self.device_id,
-                name=self.name or UNNAMED_DEVICE,
-                items=items,
-            )
-        else:
-            return (
-                "Device #{id:>9} {name:<20} " "({state}:{value}) [{methods}]"
-            ).format(
-                id=self.device_id,
-                name=self.name or UNNAMED_DEVICE,
-                state=self._str_methods(self.state),
-                value=self.statevalue,
-                methods=self._str_methods(self.methods),
+                id=self._device_id,
+                name=name,
+                items=", ".join(str(item) for item in self.items),
             )
+        return (
+            "Device #{id:>9} {name:<20} ({state}:{value}) [{methods}]"
+        ).format(
+            id=self._device_id,
+            name=name,
+            state=_str_methods(device.get("state")),
+            value=self.statevalue,
+            methods=_str_methods(device.get("methods")),
+        )
+
+    @property
+    def name(self):
+        """Name of device."""
+        return self._snapshot().get("name")
+
+    @property
+    def state(self):
+        """Last known state (method) of device."""
+        return self._snapshot().get("state")
+
+    @property
+    def battery(self):
+        """Battery status of device."""
+        return self._snapshot().get("battery")
+
+    @property
+    def model(self):
+        """Model of device."""
+        return self._snapshot().get("model")
+
+    @property
+    def protocol(self):
+        """Protocol of device."""
+        return self._snapshot().get("protocol")
+
+    @property
+    def lastUpdated(self):  # pylint: disable=invalid-name
+        """Time of last update."""
+        return self._snapshot().get("lastUpdated")
+
+    @property
+    def methods(self):
+        """Supported methods of device."""
+        return self._snapshot().get("methods")
 
-    def __getattr__(self, name):
-        if self.device and name in [
-            "name",
-            "state",
-            "battery",
-            "model",
-            "protocol",
-            "lastUpdated",
-            "methods",
-            "data",
-            "sensorId",
-        ]:
-            return self.device.get(name)
+    @property
+    def data(self):
+        """Raw sensor data items."""
+        return self._snapshot().get("data")
+
+    @property
+    def sensorId(self):  # pylint: disable=invalid-name
+        """Id of sensor on the hub."""
+        return self._snapshot().get("sensorId")
 
     @property
     def is_online(self):
@@ -481,29 +682,36 @@ class Device:
     def device(self):
         """Return the raw representation of the device."""
         # pylint: disable=protected-access
-        return self._session._device(self.device_id)
+        state = self._session._state
+        cached_state, device = self._cached
+        if state is not cached_state:
+            # Session.update replaces the state wholesale, so its identity
+            # tells us whether the cached representation is still current.
+            # Store both in one slot so that a concurrent reader never pairs
+            # the new state with the old representation.
+            device = self._session._device(self.device_id)
+            self._cached = (state, device)
+        return device
 
     @property
     def device_id(self):
         """Id of device."""
         return self._device_id
 
-    @staticmethod
-    def _str_methods(val):
-        """String representation of methods or state."""
-        res = []
-        for method in METHODS:
-            if val & method:
-                res.append(METHODS[method].upper())
-        return "|".join(res)
+    def _snapshot(self):
+        """Return the raw representation, or an empty dict if unknown."""
+        return self.device or {}
 
     def _execute(self, command, **params):
         """Send command to server and update local state."""
-        params.update(id=self.device_id)
-        # Corresponding API methods
-        method = "device/{}".format(METHODS[command])
-        if self._session.execute(method, **params):
-            self.device["state"] = command
+        device = self.device
+        if device is None:
+            # without a representation the new state would be lost
+            raise KeyError("Unknown device {}".format(self._device_id))
+        if self._session.execute(
+            _COMMAND_PATHS[command], id=self._device_id, **params
+        ):
+            device["state"] = command
             return True
 
     @property
@@ -520,12 +728,12 @@ class Device:
     @property
     def is_on(self):
         """Return true if device is on."""
-        return self.state == TURNON or self.state == DIM
+        return self._snapshot().get("state") in _ON_STATES
 
     @property
     def is_down(self):
         """Return true if device is down."""
-        return self.state == DOWN
+        return self._snapshot().get("state") == DOWN
 
     @property
     def dim_level(self):
@@ -537,10 +745,11 @@ class Device:
 
     def info(self):
         """Retrive device info."""
-        if self.is_sensor:
-            res = self.device
+        device = self._snapshot()
+        if "data" in device:
+            res = device
         else:
-            res = self._session.request_info(self.device_id)
+            res = self._session.request_info(self._device_id)
         if res and "client" not in res:
             res["client"] = self._session.hub_id
         return res if res else None
@@ -571,21 +780,31 @@ class Device:
         """Stop device."""
         return self._execute(STOP)
 
+    def _index_items(self):
+        """Build sensor items and their (name, scale) index once per data."""
+        data = self._snapshot().get("data") or ()
+        if self._items is None or data is not self._items_data:
+            self._items_data = data
+            self._items = tuple(SensorItem(item) for item in data)
+            self._items_index = {}
+            for item in self._items:
+                try:
+                    key = (item.name, int(item.scale))
+                except (TypeError, ValueError):
+                    # items without a numeric scale cannot be looked up
+                    continue
+                self._items_index.setdefault(key, item)
+
     @property
     def items(self):
         """Return sensor items for sensor."""
-        return (SensorItem(item) for item in self.data) if self.data else []
+        self._index_items()
+        return self._items
 
     def item(self, name, scale):
         """Return sensor item."""
-        return next(
-            (
-                item
-                for item in self.items
-                if (item.name == name and int(item.scale) == int(scale))
-            ),
-            None,
-        )
+        self._index_items()
+        return self._items_index.get((name, int(scale)))
 
     def value(self, name, scale):
         """Return value of sensor item."""
@@ -593,21 +812,24 @@ class Device:
 
 
 class SensorItem:
-    # pylint: disable=too-few-public-methods, no-member
+    # pylint: disable=too-few-public-methods, invalid-name
     """Reference to a sensor data item."""
 
+    __slots__ = ("name", "value", "scale", "unit", "lastUpdated")
+
     def __init__(self, data):
-        vars(self).update(data)
+        self.name = data.get("name")
+        self.value = data.get("value")
+        self.scale = data.get("scale")
+        self.unit = data.get("unit")
+        self.lastUpdated = data.get("lastUpdated")
 
     def __str__(self):
         return "{name}={value}".format(name=self.name, value=self.value)
 
 
 def read_credentials():
-    from sys import argv
-    from os.path import join, dirname, expanduser
-
-    for directory in [dirname(argv[0]), expanduser("~")]:
+    for directory in [dirname(sys.argv[0]), expanduser("~")]:
         try:
             with open(join(directory, ".tellduslive.conf")) as config:
                 return dict(
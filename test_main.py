@@ -1,2 +1,234 @@
+import json
+from datetime import timedelta
+from time import monotonic, time
+
+import pytest
+
+from tellduslive import (
+    TOKEN_REFRESH_INTERVAL,
+    Device,
+    LocalAPISession,
+    Session,
+)
+
+DEVICES = {
+    "device": [
+        {"id": 1, "name": "Lamp", "state": 2, "methods": 3},
+        {"id": 2, "name": "Dimmer", "state": 2, "methods": 19},
+    ]
+}
+
+SENSORS = {
+    "sensor": [
+        {
+            "id": 1,
+            "name": "Outside",
+            "data": [{"name": "temp", "value": "1.5", "scale": "0"}],
+        }
+    ]
+}
+
+
+class StubResponse:
+    status_code = 200
+    headers = {"content-type": "application/json"}
+
+    def __init__(self, result):
+        self.text = json.dumps(result)
+        self.content = self.text.encode()
+
+    def raise_for_status(self):
+        pass
+
+
+class StubSession:
+    """Stands in for LocalAPISession/LiveAPISession."""
+
+    url = "https://example.com/json/"
+    hub_id = None
+
+    def __init__(self):
+        self.requests = []
+        self.token_expired = False
+        self.refreshes = 0
+        self.fail = False
+        self.sensors = SENSORS
+
+    def maybe_refresh_token(self):
+        if self.token_expired:
+            self.refreshes += 1
+            self.token_expired = False
+
+    def get(self, url, params=None, timeout=None):
+        path = url[len(self.url) :]
+        self.requests.append(path)
+        if self.fail:
+            return StubResponse({"error": "unavailable"})
+        if path.startswith("devices/list"):
+            return StubResponse(DEVICES)
+        if path.startswith("sensors/list"):
+            return StubResponse(self.sensors)
+        return StubResponse({"status": "success"})
+
+
+class TokenStubResponse:
+    def __init__(self, result):
+        self._result = result
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._result
+
+
+class StubLocalAPISession(LocalAPISession):
+    """LocalAPISession handing out the queued token responses."""
+
+    def __init__(self, *tokens):
+        super().__init__("192.0.2.1", "test")
+        self.tokens = list(tokens)
+
+    def get(self, url, **kwargs):
+        return TokenStubResponse(self.tokens.pop(0))
+
+
+def stub_session(**kwargs):
+    session = Session(public_key="public", private_key="private", **kwargs)
+    session._session = StubSession()
+    return session
+
+
+def list_requests(session):
+    return [
+        path for path in session._session.requests if "/list" in path
+    ]
+
+
 def test_placeholder():
     pass
+
+
+def test_fan_out_keeps_order_and_refreshes_once():
+    session = stub_session()
+    assert session.update()
+    stub = session._session
+
+    devices = [session.device("2"), session.device("1")]
+    assert session.fan_out(devices, lambda device: device.device_id) == [
+        "2",
+        "1",
+    ]
+
+    stub.token_expired = True
+    assert session.fan_out(devices, Device.turn_on) == [True, True]
+    assert stub.refreshes == 1
+    assert all(device.is_on for device in devices)
+
+
+def test_cache_ttl_reuses_lists_within_ttl():
+    session = stub_session(cache_ttl=timedelta(minutes=1))
+    assert session.update()
+    assert session.update()
+    assert len(list_requests(session)) == 2
+
+
+def test_cache_ttl_cleared_by_successful_execute():
+    session = stub_session(cache_ttl=timedelta(minutes=1))
+    assert session.update()
+    assert session.device("1").turn_on()
+    assert session.update()
+    assert len(list_requests(session)) == 4
+
+
+def test_cache_ttl_does_not_cache_failures():
+    session = stub_session(cache_ttl=timedelta(minutes=1))
+    session._session.fail = True
+    assert not session.update()
+    session._session.fail = False
+    assert session.update()
+    assert len(list_requests(session)) == 4
+    assert session.device("_1").value("temp", 0) == "1.5"
+
+
+def test_token_expiring_soon_refreshed_on_next_request():
+    session = StubLocalAPISession(
+        {"token": "old", "expires": time() + 30},
+        {"token": "new", "expires": time() + 3600},
+    )
+    assert session.refresh_access_token()
+    session.maybe_refresh_token()
+    assert session.access_token == "new"
+    assert session._refresh_due > monotonic() + 3000
+
+
+def test_token_without_expires_refreshed_after_interval():
+    session = StubLocalAPISession({"token": "old"}, {"token": "new"})
+    assert session.refresh_access_token()
+    lifetime = session._refresh_due - monotonic()
+    interval = TOKEN_REFRESH_INTERVAL.total_seconds()
+    assert interval - 60 < lifetime <= interval
+    session.maybe_refresh_token()
+    assert session.access_token == "old"
+
+
+def test_refreshed_token_sent_in_authorization_header():
+    session = StubLocalAPISession({"token": "new", "expires": time() + 3600})
+    session.headers["Authorization"] = "Bearer old"
+    assert session.refresh_access_token()
+    assert session.headers["Authorization"] == "Bearer new"
+
+
+def test_execute_unknown_device_raises_without_sending():
+    session = stub_session()
+    assert session.update()
+    with pytest.raises(KeyError):
+        session.device("3").turn_on()
+    assert session._session.requests == list_requests(session)
+
+
+def sensor_session(*data):
+    session = stub_session()
+    session._session.sensors = {
+        "sensor": [{"id": 1, "name": "Outside", "data": list(data)}]
+    }
+    assert session.update()
+    return session
+
+
+def test_sensor_items_without_numeric_scale():
+    sensor = sensor_session(
+        {"name": "temp", "value": "1.5"},
+        {"name": "humidity", "value": "80", "scale": "%"},
+        {"name": "temp", "value": "2.5", "scale": "0"},
+    ).device("_1")
+    assert len(sensor.items) == 3
+    assert "Outside" in str(sensor)
+    assert sensor.item("humidity", 0) is None
+    assert sensor.value("temp", 0) == "2.5"
+
+
+def test_sensor_item_first_match_wins():
+    sensor = sensor_session(
+        {"name": "temp", "value": "1.5", "scale": "0"},
+        {"name": "temp", "value": "2.5", "scale": "0"},
+    ).device("_1")
+    assert sensor.value("temp", "0") == "1.5"
+
+
+def test_sensor_items_rebuilt_after_update():
+    session = sensor_session({"name": "temp", "value": "1.5", "scale": "0"})
+    sensor = session.device("_1")
+    assert sensor.value("temp", 0) == "1.5"
+    session._session.sensors = {
+        "sensor": [
+            {
+                "id": 1,
+                "name": "Outside",
+                "data": [{"name": "temp", "value": "3.0", "scale": "0"}],
+            }
+        ]
+    }
+    assert session.update()
+    assert session.device("_1") is sensor
+    assert sensor.value("temp", 0) == "3.0"